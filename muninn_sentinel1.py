@@ -1,15 +1,25 @@
 import os
 import re
 import json
+import bisect
+import pickle
+import struct
+import posixpath
 import tarfile
 import zipfile
-from datetime import datetime
+import traceback
+import zlib
+from uuid import uuid4
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
 from xml.etree.ElementTree import parse
 
+from muninn.database.ewkb import EWKBEncoder
 from muninn.schema import Mapping, Text, Integer, Timestamp
 from muninn.geometry import Point, LinearRing, Polygon, MultiPoint, MultiPolygon
 from muninn.struct import Struct
-from muninn.util import copy_path
+from muninn.util import copy_path, product_hash, product_size
 
 
 # Namespaces
@@ -199,6 +209,14 @@ AUX_EOF_PRODUCT_TYPES = [
     'AUX_RESORB',
     ]
 
+# orbit product types in order of precedence
+ORBIT_PRODUCT_TYPES = [
+    'AUX_POEORB',
+    'AUX_MOEORB',
+    'AUX_RESORB',
+    'AUX_PREORB',
+    ]
+
 MUNINN_PRODUCT_TYPES = L0_PRODUCT_TYPES + L1_PRODUCT_TYPES + L2_PRODUCT_TYPES + AUX_SAFE_PRODUCT_TYPES + \
     AISAUX_PRODUCT_TYPES + AUX_EOF_PRODUCT_TYPES
 
@@ -212,6 +230,12 @@ def parse_datetime(str):
         return datetime.strptime(str, "%Y-%m-%dT%H:%M:%S")
 
 
+def parse_xml_file(filepath):
+    # parse in binary mode, so the parser does the decoding based on the XML declaration
+    with open(filepath, "rb") as file:
+        return parse(file)
+
+
 def package_zip(paths, target_filepath):
     with zipfile.ZipFile(target_filepath, "x", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
         for path in paths:
@@ -225,6 +249,125 @@ def package_zip(paths, target_filepath):
                 archive.write(path, path[rootlen:])
 
 
+def _strip_zip64_extra(extra):
+    # remove any zip64 extended information field; it gets regenerated when the local header is written
+    result = b""
+    while len(extra) >= 4:
+        header_id, length = struct.unpack("<HH", extra[:4])
+        if header_id != 0x0001:
+            result += extra[:4 + length]
+        extra = extra[4 + length:]
+    return result
+
+
+def copy_zip_member(source, info, target, arcname=None):
+    """Copy a member from one open zip file to another without decompressing and recompressing it.
+
+    The compressed data and CRC of the member are transferred as-is; only the member name (if `arcname` is given)
+    and the zip headers are rewritten.
+    """
+    # The zipfile module has no public API for writing raw member data, so this relies on CPython ZipFile internals:
+    # `fp` (the underlying file of both zip files), `start_dir` (the offset at which the next member is written),
+    # `filelist` and `NameToInfo` (the members written to the central directory on close), and `_didModify` (forces
+    # the central directory to be written). The `_writecheck()` checks and `_lock` are skipped, so `target` should
+    # not be written to concurrently. tests/test_muninn_sentinel1.py verifies this still round-trips.
+    if info.flag_bits & 0x01:
+        raise zipfile.BadZipFile("cannot copy encrypted zip member '%s'" % info.filename)
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("bad local file header for zip member '%s'" % info.filename)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    source.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+    zinfo = zipfile.ZipInfo(arcname or info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.extra = _strip_zip64_extra(info.extra)
+    zinfo.create_system = info.create_system
+    zinfo.internal_attr = info.internal_attr
+    zinfo.external_attr = info.external_attr
+    zinfo.flag_bits = info.flag_bits & ~0x08  # sizes are known, so no data descriptor is written
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    if zinfo.filename in target.NameToInfo:
+        raise ValueError("duplicate zip member '%s'" % zinfo.filename)
+
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    target.fp.seek(target.start_dir)
+    zinfo.header_offset = target.fp.tell()
+    target.fp.write(zinfo.FileHeader(zip64))
+    remaining = info.compress_size
+    while remaining > 0:
+        data = source.fp.read(min(remaining, 1024 * 1024))
+        if not data:
+            raise zipfile.BadZipFile("truncated data for zip member '%s'" % info.filename)
+        target.fp.write(data)
+        remaining -= len(data)
+    target.start_dir = target.fp.tell()
+    target.filelist.append(zinfo)
+    target.NameToInfo[zinfo.filename] = zinfo
+    target._didModify = True
+
+
+def repackage_zip(source_filepaths, target_filepath, rename=None):
+    """Combine the members of one or more zip files into a new zip file without recompressing them.
+
+    If given, `rename` is called with each source member name and should return the name to use in the target zip
+    file, or None to leave the member out.
+    """
+    with zipfile.ZipFile(target_filepath, "x", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        try:
+            for source_filepath in source_filepaths:
+                with zipfile.ZipFile(source_filepath) as source:
+                    for info in source.infolist():
+                        arcname = info.filename if rename is None else rename(info.filename)
+                        if arcname is not None:
+                            copy_zip_member(source, info, archive, arcname)
+        except Exception:
+            archive.close()
+            os.remove(target_filepath)
+            raise
+
+
+def select_safe_members(root, polarisations=None, swaths=None, components=None):
+    """Return the paths (relative to the SAFE directory) of the dataObjects in a SAFE manifest that match the filters.
+
+    Components are matched against the repID of a dataObject, either in full (e.g. 's1Level1MeasurementSchema') or
+    in short form (e.g. 'measurement', or 'product' for the annotation files). Polarisation and swath are taken from
+    the ([<prefix>-]s1x-<swath>-...-<polarisation>-...) filename of a dataObject and only filter dataObjects that have
+    them.
+    """
+    if polarisations is not None:
+        polarisations = [x.lower() for x in polarisations]
+    if swaths is not None:
+        swaths = [x.lower() for x in swaths]
+    if components is not None:
+        components = [x.lower() for x in components]
+    members = []
+    for data_object in root.findall("./dataObjectSection/dataObject"):
+        rep_id = data_object.get("repID", "")
+        href = posixpath.normpath(data_object.find("./byteStream/fileLocation").get("href"))
+        if components is not None:
+            match = re.match(r"^s1(?:Level\d)?(?P<component>\w+?)Schema$", rep_id)
+            component = match.group("component") if match else rep_id
+            if rep_id.lower() not in components and component.lower() not in components:
+                continue
+        fields = posixpath.basename(href).lower().split("-")
+        # skip any prefix such as 'calibration-', 'noise-', or 'rfi-' in front of the mission
+        mission_index = [i for i, field in enumerate(fields) if re.match(r"^s1[_abcd]?$", field)]
+        if mission_index and len(fields) > mission_index[0] + 2:
+            fields = fields[mission_index[0]:]
+            if swaths is not None and fields[1] not in swaths:
+                continue
+            polarisation = [x for x in fields[2:] if x in ("hh", "hv", "vh", "vv")]
+            if polarisations is not None and polarisation and polarisation[0] not in polarisations:
+                continue
+        members.append(href)
+    return members
+
+
 class Sentinel1Product(object):
 
     def __init__(self, product_type):
@@ -270,9 +413,12 @@ class Sentinel1Product(object):
 
 class SAFEProduct(Sentinel1Product):
 
-    def __init__(self, product_type, zipped=False):
+    member_filter = None
+
+    def __init__(self, product_type, zipped=False, member_filter=None):
         self.product_type = product_type
         self.zipped = zipped
+        self.member_filter = member_filter
         pattern = [
             r"^(?P<mission>S1(_|A|B|C|D))",
             r"(?P<product_type>%s)(?P<polarisation>.{2})" % product_type,
@@ -357,8 +503,7 @@ class SAFEProduct(Sentinel1Product):
                 with zproduct.open(componentpath) as manifest:
                     return parse(manifest).getroot()
         else:
-            with open(os.path.join(filepath, componentpath)) as manifest:
-                return parse(manifest).getroot()
+            return parse_xml_file(os.path.join(filepath, componentpath)).getroot()
 
     def analyze(self, paths, filename_only=False):
         inpath = paths[0]
@@ -401,11 +546,49 @@ class SAFEProduct(Sentinel1Product):
 
         return properties
 
+    def package_members(self, inpath, target_filepath, polarisations=None, swaths=None, components=None):
+        root = self.read_xml_component(inpath, "manifest.safe")
+        members = ["manifest.safe"] + select_safe_members(root, polarisations, swaths, components)
+        if self.zipped:
+            rootdir = os.path.splitext(os.path.basename(inpath))[0]
+            members = set(posixpath.join(rootdir, member) for member in members)
+            repackage_zip([inpath], target_filepath, lambda name: name if name in members else None)
+        else:
+            rootdir = os.path.basename(inpath)
+            with zipfile.ZipFile(target_filepath, "x", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+                for member in members:
+                    archive.write(os.path.join(inpath, member), posixpath.join(rootdir, member))
+
     def export_zip(self, archive, properties, target_path, paths):
+        if self.member_filter is not None:
+            assert len(paths) == 1, "SAFE product should be a single file or directory"
+            target_filepath = os.path.join(os.path.abspath(target_path), os.path.basename(paths[0]))
+            if not self.zipped:
+                target_filepath += ".zip"
+            self.package_members(paths[0], target_filepath, **self.member_filter)
+            return target_filepath
         if self.zipped:
             assert len(paths) == 1, "zipped product should be a single file"
-            copy_path(paths[0], target_path)
-            return os.path.join(target_path, os.path.basename(paths[0]))
+            rootdir = os.path.splitext(os.path.basename(paths[0]))[0]
+            with zipfile.ZipFile(paths[0]) as zproduct:
+                names = zproduct.namelist()
+            if all(name.startswith(rootdir + "/") for name in names):
+                copy_path(paths[0], target_path)
+                return os.path.join(target_path, os.path.basename(paths[0]))
+            # only rewrite the member names if the zip file clearly contains a single SAFE product with a different
+            # root directory (or without a root directory); anything else is exported as-is
+            topdirs = set(name.split("/")[0] for name in names)
+            if "manifest.safe" in names:
+                names = dict((name, posixpath.join(rootdir, name)) for name in names)
+            elif len(topdirs) == 1 and all("/" in name for name in names) and \
+                    posixpath.join(topdirs.pop(), "manifest.safe") in names:
+                names = dict((name, posixpath.join(rootdir, name.split("/", 1)[1])) for name in names)
+            else:
+                copy_path(paths[0], target_path)
+                return os.path.join(target_path, os.path.basename(paths[0]))
+            target_filepath = os.path.join(os.path.abspath(target_path), os.path.basename(paths[0]))
+            repackage_zip(paths, target_filepath, names.get)
+            return target_filepath
         target_filepath = os.path.join(os.path.abspath(target_path), properties.core.physical_name + ".zip")
         package_zip(paths, target_filepath)
         return target_filepath
@@ -413,9 +596,10 @@ class SAFEProduct(Sentinel1Product):
 
 class AUXProduct(SAFEProduct):
 
-    def __init__(self, product_type, zipped=False):
+    def __init__(self, product_type, zipped=False, member_filter=None):
         self.product_type = product_type
         self.zipped = zipped
+        self.member_filter = member_filter
         pattern = [
             r"^(?P<mission>S1(_|A|B|C|D))",
             r"(?P<product_type>%s)" % product_type,
@@ -464,9 +648,10 @@ class AUXProduct(SAFEProduct):
 
 class AISAUXProduct(SAFEProduct):
 
-    def __init__(self, product_type, zipped=False):
+    def __init__(self, product_type, zipped=False, member_filter=None):
         self.product_type = product_type
         self.zipped = zipped
+        self.member_filter = member_filter
         pattern = [
             r"^(?P<mission>S1(_|A|B|C|D))",
             r"(?P<product_type>%s)" % product_type,
@@ -577,8 +762,7 @@ class EOFProduct(Sentinel1Product):
                 with tarfile.open(filepath, "r:gz") as tar:
                     return parse(tar.extractfile(hdrpath)).getroot()
             else:
-                with open(filepath) as hdrfile:
-                    return parse(hdrfile).getroot()
+                return parse_xml_file(filepath).getroot()
         else:
             ns = self.xml_namespace
             if self.zipped:
@@ -587,8 +771,7 @@ class EOFProduct(Sentinel1Product):
                     with zproduct.open(eofpath) as eoffile:
                         return parse(eoffile).getroot().find("./Earth_Explorer_Header", ns)
             else:
-                with open(filepath) as eoffile:
-                    return parse(eoffile).getroot().find("./Earth_Explorer_Header", ns)
+                return parse_xml_file(filepath).getroot().find("./Earth_Explorer_Header", ns)
 
     def analyze(self, paths, filename_only=False):
         if self.split and not self.zipped:
@@ -790,3 +973,439 @@ def product_types():
 
 def product_type_plugin(product_type):
     return _product_types.get(product_type)
+
+
+def identify(paths):
+    for product_type, plugin in _product_types.items():
+        if plugin.identify(paths):
+            return product_type
+    return None
+
+
+def export_members(paths, target_path, polarisations=None, swaths=None, components=None):
+    """Export the manifest and the selected members of a SAFE product to a zip file in `target_path`.
+
+    `paths` should contain a single .SAFE directory or .SAFE.zip file. See select_safe_members() for the filters.
+    Returns the path of the zip file.
+    """
+    assert len(paths) == 1, "SAFE product should be a single file or directory"
+    name = os.path.basename(paths[0])
+    zipped = name.endswith(".zip")
+    product_type = identify([os.path.splitext(name)[0] if zipped else name])
+    plugin = product_type_plugin(product_type) if product_type is not None else None
+    if not isinstance(plugin, SAFEProduct) or isinstance(plugin, OBSProduct):
+        raise ValueError("'%s' is not a SAFE product" % name)
+    if zipped:
+        plugin = type(plugin)(product_type, zipped=True)
+    target_filepath = os.path.join(os.path.abspath(target_path), name if zipped else name + ".zip")
+    plugin.package_members(paths[0], target_filepath, polarisations, swaths, components)
+    return target_filepath
+
+
+CORE_COLUMNS = [
+    'uuid',
+    'active',
+    'hash',
+    'size',
+    'metadata_date',
+    'product_type',
+    'product_name',
+    'physical_name',
+    'validity_start',
+    'validity_stop',
+    'creation_date',
+    'footprint',
+    ]
+
+
+def analyze_batch(products, filename_only=False, compute_hash=False, failures=None):
+    """Analyze a list of (product_type, paths) pairs and return the properties as a columnar batch.
+
+    The result maps column names ('core.<name>' and 'sentinel1.<name>') to lists with one value per product (None if
+    a property is not set). Each product gets a newly generated uuid, which is also used for its sentinel1 row, and is
+    marked active. The rows of a table, as given by zip() over the columns of its namespace, can therefore be loaded
+    with a single executemany/COPY per table. Footprints are encoded as WKB (e.g. for ST_GeogFromWKB / GeomFromWKB).
+    The product hash is only computed if `compute_hash` is set, and the size only if `filename_only` is not set.
+
+    If a `failures` list is given, products that cannot be analyzed are skipped and appended to it as
+    (product_type, paths, exception) tuples; otherwise the first failure is raised.
+    """
+    columns = ["core." + name for name in CORE_COLUMNS] + ["sentinel1.uuid"] + \
+        ["sentinel1." + name for name in Sentinel1Namespace]
+    batch = dict((column, []) for column in columns)
+    encoder = EWKBEncoder(srid=None)
+    metadata_date = datetime.now(timezone.utc).replace(tzinfo=None)
+    for product_type, paths in products:
+        try:
+            plugin = product_type_plugin(product_type)
+            if plugin is None:
+                raise ValueError("unknown product type '%s'" % product_type)
+            properties = plugin.analyze(paths, filename_only)
+            core = properties.core
+            core.uuid = properties.sentinel1.uuid = uuid4()
+            core.active = True
+            core.metadata_date = metadata_date
+            core.product_type = product_type
+            if plugin.use_enclosing_directory:
+                core.physical_name = plugin.enclosing_directory(properties)
+            else:
+                core.physical_name = os.path.basename(paths[0])
+            if not filename_only:
+                core.size = product_size(paths)
+            if compute_hash:
+                core.hash = product_hash(paths, hash_type=plugin.hash_type)
+            if "footprint" in core:
+                core.footprint = encoder.visit(core.footprint)
+        except Exception as _error:
+            if failures is None:
+                raise
+            failures.append((product_type, paths, _error))
+            continue
+        for column in columns:
+            namespace_name, name = column.split(".")
+            namespace = properties[namespace_name]
+            batch[column].append(namespace[name] if name in namespace else None)
+    return batch
+
+
+class _PickledIndex(object):
+
+    def save(self, filepath):
+        with open(filepath, "wb") as file:
+            pickle.dump(self, file, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath, "rb") as file:
+            index = pickle.load(file)
+        if not isinstance(index, cls):
+            raise TypeError("'%s' does not contain a %s" % (filepath, cls.__name__))
+        return index
+
+
+class OrbitIndex(_PickledIndex):
+    """In-memory index of orbit files on validity period, for selecting the best orbit file for a time window.
+
+    Per mission and orbit product type the orbit files are kept sorted on validity start. Since orbit files of the
+    same type have a bounded duration, only the few files that start within that duration of a time window need to be
+    checked, giving O(log n) lookups.
+    """
+
+    def __init__(self, products=()):
+        self._starts = {}  # (mission, product_type) -> sorted list of validity starts
+        self._entries = {}  # (mission, product_type) -> list of (start, stop, creation_date, product_name) tuples
+        self._max_duration = {}  # (mission, product_type) -> longest validity period
+        for properties in products:
+            self.add(properties)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def add(self, properties, product_type=None):
+        if product_type is None:
+            if "product_type" in properties.core:
+                product_type = properties.core.product_type
+            else:
+                product_type = properties.core.product_name[9:19]  # S1x_<file class>_<product type>_...
+        if product_type not in ORBIT_PRODUCT_TYPES:
+            raise ValueError("'%s' is not an orbit product type" % product_type)
+        core = properties.core
+        key = (properties.sentinel1.mission, product_type)
+        entry = (core.validity_start, core.validity_stop, core.creation_date, core.product_name)
+        starts = self._starts.setdefault(key, [])
+        entries = self._entries.setdefault(key, [])
+        index = bisect.bisect_right(entries, entry)
+        if index > 0 and entries[index - 1] == entry:
+            return
+        starts.insert(index, core.validity_start)
+        entries.insert(index, entry)
+        duration = core.validity_stop - core.validity_start
+        if duration > self._max_duration.get(key, timedelta(0)):
+            self._max_duration[key] = duration
+
+    def best(self, mission, validity_start, validity_stop):
+        """Return the product name of the best orbit file covering the given time window (or None if there is none).
+
+        Orbit product types are ranked by precedence (see ORBIT_PRODUCT_TYPES), with the most recently created file
+        chosen in case several files of the same type cover the window.
+        """
+        for product_type in ORBIT_PRODUCT_TYPES:
+            key = (mission, product_type)
+            if key not in self._starts:
+                continue
+            starts = self._starts[key]
+            try:
+                lower = bisect.bisect_left(starts, validity_stop - self._max_duration[key])
+            except OverflowError:
+                lower = 0
+            upper = bisect.bisect_right(starts, validity_start)
+            candidates = [entry for entry in self._entries[key][lower:upper] if entry[1] >= validity_stop]
+            if candidates:
+                return max(candidates, key=lambda entry: entry[2])[3]
+        return None
+
+
+class DatatakeIndex(_PickledIndex):
+    """In-memory index that groups analysed products on (mission, datatake_id).
+
+    Per mission (and per mission and relative orbit) the datatakes are kept sorted on start time, so the datatakes
+    overlapping a time window can be found with a bisect, as for OrbitIndex.
+    """
+
+    def __init__(self, products=()):
+        self._datatakes = {}  # (mission, datatake_id) -> Struct with start, stop, relative_orbit, products
+        self._starts = {}  # (mission, relative_orbit or None) -> sorted list of (start, datatake_id) tuples
+        self._max_duration = {}  # mission -> longest datatake duration
+        for properties in products:
+            self.add(properties)
+
+    def __len__(self):
+        return len(self._datatakes)
+
+    def _insert(self, key, start, datatake_id):
+        bisect.insort(self._starts.setdefault(key, []), (start, datatake_id))
+
+    def _remove(self, key, start, datatake_id):
+        starts = self._starts[key]
+        del starts[bisect.bisect_left(starts, (start, datatake_id))]
+
+    def add(self, properties, product_type=None):
+        if product_type is None:
+            if "product_type" in properties.core:
+                product_type = properties.core.product_type
+            else:
+                product_type = properties.core.product_name[4:14]  # S1x_<product type>_...
+        sentinel1 = properties.sentinel1
+        if "datatake_id" not in sentinel1:
+            raise ValueError("product '%s' has no datatake id" % properties.core.product_name)
+        core = properties.core
+        mission = sentinel1.mission
+        datatake_id = sentinel1.datatake_id
+        relative_orbit = sentinel1.relative_orbit if "relative_orbit" in sentinel1 else None
+
+        datatake = self._datatakes.get((mission, datatake_id))
+        if datatake is None:
+            datatake = self._datatakes[(mission, datatake_id)] = Struct()
+            datatake.start = core.validity_start
+            datatake.stop = core.validity_stop
+            datatake.relative_orbit = None
+            datatake.products = []
+            self._insert((mission, None), datatake.start, datatake_id)
+
+        # a product that is added again (e.g. after full analysis) replaces its earlier entry
+        entry = (core.validity_start, core.validity_stop, product_type, core.product_name)
+        datatake.products = [x for x in datatake.products if x[3] != core.product_name]
+        bisect.insort(datatake.products, entry)
+
+        start = datatake.products[0][0]
+        if start != datatake.start:
+            self._remove((mission, None), datatake.start, datatake_id)
+            self._insert((mission, None), start, datatake_id)
+            if datatake.relative_orbit is not None:
+                self._remove((mission, datatake.relative_orbit), datatake.start, datatake_id)
+                self._insert((mission, datatake.relative_orbit), start, datatake_id)
+            datatake.start = start
+        datatake.stop = max(x[1] for x in datatake.products)
+        if datatake.relative_orbit is None and relative_orbit is not None:
+            datatake.relative_orbit = relative_orbit
+            self._insert((mission, relative_orbit), datatake.start, datatake_id)
+        if datatake.stop - datatake.start > self._max_duration.get(mission, timedelta(0)):
+            self._max_duration[mission] = datatake.stop - datatake.start
+
+    def products(self, mission, datatake_id, product_types=None):
+        """Return the names of the products of a datatake sorted on validity start (e.g. the slices of a datatake).
+
+        Products can be restricted to a list of product types (e.g. all L0, L1, and L2 products for one mode).
+        """
+        datatake = self._datatakes.get((mission, datatake_id))
+        if datatake is None:
+            return []
+        return [entry[3] for entry in datatake.products if product_types is None or entry[2] in product_types]
+
+    def datatakes(self, mission, validity_start, validity_stop, relative_orbit=None):
+        """Return the ids of the datatakes of a mission that overlap the given time window, sorted on start time.
+
+        If `relative_orbit` is given, only datatakes on that relative orbit are returned.
+        """
+        starts = self._starts.get((mission, relative_orbit))
+        if not starts:
+            return []
+        try:
+            lower = bisect.bisect_left(starts, (validity_start - self._max_duration[mission],))
+        except OverflowError:
+            lower = 0
+        upper = bisect.bisect_right(starts, (validity_stop, float("inf")))
+        return [datatake_id for start, datatake_id in starts[lower:upper]
+                if self._datatakes[(mission, datatake_id)].stop >= validity_start]
+
+
+_RECORD_HEADER = struct.Struct("<QI")  # length and crc32 of a checkpoint log record
+
+
+def _analyze_paths(paths, filename_only):
+    try:
+        product_type = identify(paths)
+        if product_type is None:
+            raise ValueError("unable to identify product %s" % paths)
+        return product_type, product_type_plugin(product_type).analyze(paths, filename_only), None
+    except Exception:
+        return None, None, traceback.format_exc()
+
+
+class AnalysisJob(object):
+    """Resumable bulk analysis of products using a pool of worker processes.
+
+    Each input item is a path (or a list of paths) of a product. Results are appended in input order to a checkpoint
+    log of pickled records. Running the job again with the same checkpoint log and input skips the items that were
+    already committed. Products that cannot be identified or analysed are logged with their traceback and can be
+    retrieved with quarantined(). At most `max_pending` items are in flight at any time, which bounds memory use.
+
+    If a worker process dies (e.g. when running out of memory), the pool is restarted and the items that were in
+    flight are analysed again one at a time in a separate single worker pool; an item that also kills that worker is
+    quarantined.
+    """
+
+    def __init__(self, checkpoint_path, workers=None, max_pending=None, filename_only=False):
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 4 * self.workers
+        self.filename_only = filename_only
+
+    def _read_log(self):
+        # yield (position after record, record) for each complete record in the checkpoint log; each record is
+        # stored as its length and crc32 followed by the pickled record
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, "rb") as log:
+            while True:
+                position = log.tell()
+                header = log.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    return  # end of log, or a partially written record from an interrupted run
+                length, crc = _RECORD_HEADER.unpack(header)
+                data = log.read(length)
+                if len(data) < length:
+                    return  # partially written record from an interrupted run
+                if zlib.crc32(data) != crc:
+                    raise ValueError("corrupt record at position %d in checkpoint log '%s'" %
+                                     (position, self.checkpoint_path))
+                yield log.tell(), pickle.loads(data)
+
+    def records(self):
+        for _, record in self._read_log():
+            yield record
+
+    def results(self):
+        for record in self.records():
+            if record.error is None:
+                yield record
+
+    def quarantined(self):
+        for record in self.records():
+            if record.error is not None:
+                yield record
+
+    def committed(self):
+        """Return the number of input items that have been committed to the checkpoint log."""
+        return sum(1 for _ in self._read_log())
+
+    def _recover(self):
+        committed = 0
+        position = 0
+        for position, record in self._read_log():
+            committed += 1
+        if os.path.exists(self.checkpoint_path) and os.path.getsize(self.checkpoint_path) > position:
+            with open(self.checkpoint_path, "r+b") as log:
+                log.truncate(position)
+        return committed
+
+    def _submit(self, offset):
+        # a pool can already be broken (by a worker that died) before one of its futures reports it
+        while True:
+            paths, _, isolated = self._pending[offset]
+            if isolated:
+                if self._isolation_executor is None:
+                    self._isolation_executor = ProcessPoolExecutor(1)
+                executor = self._isolation_executor
+            else:
+                executor = self._executor
+            try:
+                self._pending[offset][1] = executor.submit(_analyze_paths, paths, self.filename_only)
+                return
+            except BrokenProcessPool:
+                self._pending[offset][1] = None
+                self._restart(isolated)
+
+    def _restart(self, isolated):
+        # handle a broken pool: restart it and resubmit the items it was processing to the isolation pool
+        offsets = sorted(offset for offset, (_, future, x) in self._pending.items()
+                         if x == isolated and future is not None)
+        wait([self._pending[offset][1] for offset in offsets])
+        broken = [offset for offset in offsets if isinstance(self._pending[offset][1].exception(), BrokenProcessPool)]
+        if isolated:
+            # the isolation pool runs one item at a time in offset order, so the first broken item is the one that
+            # killed the worker (if the worker died while idle, there is none)
+            self._isolation_executor.shutdown(wait=False)
+            self._isolation_executor = None
+            if broken:
+                culprit = broken.pop(0)
+                future = Future()
+                future.set_result((None, None, "worker process terminated abruptly while analysing %s" %
+                                   (self._pending[culprit][0],)))
+                self._pending[culprit][1] = future
+        else:
+            self._executor.shutdown(wait=False)
+            self._executor = ProcessPoolExecutor(self.workers)
+        for offset in broken:
+            self._pending[offset][2] = True
+            self._submit(offset)
+
+    def _commit(self, log, offset, block):
+        # write the results of all finished items at the head of the queue (waiting for the first one if requested)
+        start = offset
+        while offset in self._pending and (block or self._pending[offset][1].done()):
+            paths, future, isolated = self._pending[offset]
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                self._restart(isolated)
+                continue
+            del self._pending[offset]
+            record = Struct()
+            record.offset = offset
+            record.paths = paths
+            record.product_type, record.properties, record.error = result
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            log.write(_RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data)
+            offset += 1
+            block = False
+        if offset != start:
+            log.flush()
+            os.fsync(log.fileno())
+        return offset
+
+    def run(self, items):
+        """Analyze all items that have not been committed yet and return the total number of committed items."""
+        committed = self._recover()
+        self._pending = {}  # offset -> [paths, future, analysed in isolation pool]
+        self._executor = ProcessPoolExecutor(self.workers)
+        self._isolation_executor = None
+        try:
+            with open(self.checkpoint_path, "ab") as log:
+                for offset, item in enumerate(items):
+                    if offset < committed:
+                        continue
+                    paths = [item] if isinstance(item, str) else list(item)
+                    self._pending[offset] = [paths, None, False]
+                    self._submit(offset)
+                    while len(self._pending) >= self.max_pending:
+                        committed = self._commit(log, committed, True)
+                    committed = self._commit(log, committed, False)
+                while self._pending:
+                    committed = self._commit(log, committed, True)
+        finally:
+            self._executor.shutdown()
+            if self._isolation_executor is not None:
+                self._isolation_executor.shutdown()
+            del self._pending, self._executor, self._isolation_executor
+        return committed
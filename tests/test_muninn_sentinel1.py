@@ -0,0 +1,163 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+from unittest import mock
+
+import muninn_sentinel1
+
+_analyze_paths = muninn_sentinel1._analyze_paths
+
+SAFE_NAME = "S1A_IW_SLC__1SDV_20230101T%02d0000_20230101T%02d0030_046000_058000_ABCD.SAFE"
+
+
+def _crashing_analyze_paths(paths, filename_only):
+    # kill the worker process for 'crash' items, and make other items take some time
+    if paths[0] == "crash":
+        os._exit(1)
+    time.sleep(0.02)
+    return _analyze_paths(paths, filename_only)
+
+
+def _items(count, crash, delay=0):
+    for index in range(count):
+        time.sleep(delay)
+        yield "crash" if index in crash else SAFE_NAME % (index % 24, index % 24)
+
+
+class UnseekableFile(io.RawIOBase):
+
+    def __init__(self, file):
+        self.file = file
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.file.write(data)
+
+
+class CopyZipMemberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, "source.zip")
+        self.members = [
+            ("deflated.xml", b"<a>" + b"x" * 100000 + b"</a>", zipfile.ZIP_DEFLATED),
+            ("stored.bin", os.urandom(1000), zipfile.ZIP_STORED),
+            ("dir/ünicode.txt", b"utf-8 name", zipfile.ZIP_DEFLATED),
+            ("empty", b"", zipfile.ZIP_DEFLATED),
+        ]
+        # members written to an unseekable file have a data descriptor after their data (and no sizes in the local
+        # file header), which copy_zip_member() should not carry over
+        with open(self.source, "wb") as file:
+            with zipfile.ZipFile(UnseekableFile(file), "w", zipfile.ZIP_DEFLATED) as archive:
+                for name, data, compress_type in self.members:
+                    archive.writestr(name, data, compress_type)
+                with archive.open("streamed.dat", "w") as member:
+                    member.write(b"streamed" * 1000)
+        self.members.append(("streamed.dat", b"streamed" * 1000, zipfile.ZIP_DEFLATED))
+        with zipfile.ZipFile(self.source) as archive:
+            self.assertTrue(all(info.flag_bits & 0x08 for info in archive.infolist()))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        target = os.path.join(self.tmpdir, "target.zip")
+        muninn_sentinel1.repackage_zip([self.source], target, lambda name: "root/" + name)
+        with zipfile.ZipFile(self.source) as source, zipfile.ZipFile(target) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ["root/" + name for name, _, _ in self.members])
+            for name, data, compress_type in self.members:
+                info = archive.getinfo("root/" + name)
+                self.assertEqual(archive.read(info), data)
+                self.assertEqual(info.compress_type, compress_type)
+                self.assertEqual(info.compress_type, source.getinfo(name).compress_type)
+                self.assertEqual(info.CRC, source.getinfo(name).CRC)
+                self.assertEqual(info.compress_size, source.getinfo(name).compress_size)
+                self.assertFalse(info.flag_bits & 0x08)
+
+    def test_append_after_copy(self):
+        # members written through the public API after a raw copy should not overwrite the copied data
+        target = os.path.join(self.tmpdir, "target.zip")
+        with zipfile.ZipFile(self.source) as source, zipfile.ZipFile(target, "w") as archive:
+            muninn_sentinel1.copy_zip_member(source, source.getinfo("deflated.xml"), archive)
+            archive.writestr("extra.txt", b"extra")
+        with zipfile.ZipFile(target) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read("deflated.xml"), self.members[0][1])
+            self.assertEqual(archive.read("extra.txt"), b"extra")
+
+    def test_duplicate_member(self):
+        target = os.path.join(self.tmpdir, "target.zip")
+        with self.assertRaises(ValueError):
+            muninn_sentinel1.repackage_zip([self.source], target, lambda name: "duplicate")
+        self.assertFalse(os.path.exists(target))
+
+
+class AnalysisJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.tmpdir, "checkpoint.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_job(self, items):
+        job = muninn_sentinel1.AnalysisJob(self.checkpoint_path, workers=2, max_pending=8, filename_only=True)
+        with mock.patch.object(muninn_sentinel1, "_analyze_paths", _crashing_analyze_paths):
+            return job, job.run(items)
+
+    def test_run(self):
+        job, committed = self.run_job(list(_items(20, [])) + ["garbage"])
+        self.assertEqual(committed, 21)
+        self.assertEqual([record.offset for record in job.records()], list(range(21)))
+        self.assertEqual(len(list(job.results())), 20)
+        self.assertEqual([record.offset for record in job.quarantined()], [20])
+        self.assertEqual(next(job.results()).properties.core.product_name, os.path.splitext(SAFE_NAME % (0, 0))[0])
+
+    def test_worker_crash_while_submitting(self):
+        # the worker dies while the next input item is being produced, so the broken pool shows up on submit
+        job, committed = self.run_job(_items(30, [10], delay=0.05))
+        self.assertEqual(committed, 30)
+        self.assertEqual([record.offset for record in job.records()], list(range(30)))
+        self.assertEqual([record.offset for record in job.quarantined()], [10])
+        self.assertEqual(self.run_job(_items(30, [10]))[1], 30)
+
+    def test_worker_crash_at_queue_head(self):
+        job, committed = self.run_job(_items(30, [12, 25]))
+        self.assertEqual(committed, 30)
+        self.assertEqual([record.offset for record in job.records()], list(range(30)))
+        self.assertEqual([record.offset for record in job.quarantined()], [12, 25])
+
+    def test_resume(self):
+        self.run_job(_items(10, []))
+        with open(self.checkpoint_path, "ab") as log:
+            log.write(b"\x10\x00\x00\x00\x00\x00\x00\x00partial")  # record header and part of its data
+        job = muninn_sentinel1.AnalysisJob(self.checkpoint_path)
+        self.assertEqual(job.committed(), 10)
+        job, committed = self.run_job(_items(15, []))
+        self.assertEqual(committed, 15)
+        self.assertEqual([record.offset for record in job.records()], list(range(15)))
+
+    def test_corrupt_log(self):
+        self.run_job(_items(10, []))
+        with open(self.checkpoint_path, "rb") as log:
+            data = bytearray(log.read())
+        data[len(data) // 2] ^= 0xff
+        with open(self.checkpoint_path, "wb") as log:
+            log.write(data)
+        with self.assertRaises(ValueError):
+            muninn_sentinel1.AnalysisJob(self.checkpoint_path).committed()
+        with self.assertRaises(ValueError):
+            self.run_job(_items(15, []))
+        self.assertEqual(os.path.getsize(self.checkpoint_path), len(data))
+
+
+if __name__ == "__main__":
+    unittest.main()